@@ -3,189 +3,536 @@
 #===================#
 
 import os
+import hashlib
+import shelve
 import threading
 import time
+import orjson
+import redis
+import numpy as np
 import google.generativeai as genai
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
 from flask_cors import CORS
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
 
 # --- Configuration ---
 ES_HOST = "http://localhost:64298"
 INDEX_PATTERN = "logstash-*"
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
+# Size the connection pool for concurrent request threads plus the scheduler jobs
+ES_CONNECTIONS_PER_NODE = 25
+# Per-query timeouts (seconds), sized to each query's expected cost so a struggling
+# Elasticsearch fails fast instead of tying up a thread for the client-wide 30s
+ES_DASHBOARD_TIMEOUT = 5
+ES_AI_QUERY_TIMEOUT = 10
+ES_PING_TIMEOUT = 5
 # --- IMPORTANT: Add your Gemini API Key here ---
 GEMINI_API_KEY = "GEMINI_API_KEY"
 
-# --- Flask App & AI Cache Initialization ---
+# --- Flask App Initialization ---
 app = Flask(__name__)
 CORS(app)
-ai_analysis_cache = {
+
+# --- Shared Caches (Redis) ---
+# The dashboard and AI analysis are stored in Redis as pre-serialized JSON so
+# every gunicorn worker serves the same snapshot.
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
+AI_ANALYSIS_KEY = "ai_analysis"
+AI_ANALYSIS_TTL = 3600  # seconds
+DASHBOARD_KEY = "dashboard"
+AI_REFRESH_SECONDS = 600
+DASHBOARD_REFRESH_SECONDS = 30
+# Served until the first AI analysis has been stored
+AI_ANALYSIS_PLACEHOLDER = {
     "summary": "AI analysis is initializing. Please check back in a few minutes...",
     "threat_type": "Initializing...",
     "recommendations": ["Waiting for first data batch..."],
     "last_updated": None
 }
+# Keeps a worker from starting a dashboard refresh while its previous one is still running
+_dashboard_cache_lock = threading.Lock()
+# Single-flight for the AI analysis: a run that starts while another is still waiting
+# on Gemini is skipped. Reentrant so the combined task can hold it across its own call.
+_ai_lock = threading.RLock()
+
+# --- AI Prompt ---
+# The static analyst instructions come first so the prompt prefix stays
+# byte-identical between runs; only the briefing at the end changes.
+AI_PROMPT_TEMPLATE = """You are a senior cybersecurity analyst. Based on the following honeypot activity summary, provide a concise analysis in JSON format. The JSON object must have three keys: "summary", "threat_type", and "recommendations".
+
+- "summary": A brief, one-sentence summary of the activity in plain English.
+- "threat_type": A short, descriptive label for the dominant threat pattern (e.g., "Automated Scanning", "SSH Brute-Force", "Web Server Probing", "Coordinated Attack").
+- "recommendations": A JSON array of 2 short, actionable mitigation steps a security admin should take.
+
+Provide only the raw JSON object as your response.
+
+Here is the data:
+{briefing}"""
+
+# Structured output schema, so Gemini always returns exactly the keys the dashboard reads
+AI_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "threat_type": {"type": "string"},
+        "recommendations": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["summary", "threat_type", "recommendations"]
+}
+
+# --- AI Exact-Match Cache ---
+# Gemini analyses keyed by the SHA-256 of the briefing text, persisted on disk
+# so a restart does not throw them away. An unchanged briefing skips Gemini.
+EXACT_CACHE_DIR = os.path.expanduser("~/.honeypot_cache")
+EXACT_CACHE_PATH = os.path.join(EXACT_CACHE_DIR, "ai_analysis")
+EXACT_CACHE_TTL = 3600  # seconds
+
+# --- AI Semantic Cache ---
+# Recent Gemini analyses keyed by the embedding of the briefing that produced
+# them. A new briefing that reads almost the same reuses the cached analysis
+# instead of paying for another Gemini call. The entries live in Redis so
+# whichever worker claims an AI run sees every earlier briefing.
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.95  # minimum cosine similarity for a hit
+SEMANTIC_CACHE_TTL = 3600  # seconds
+SEMANTIC_CACHE_MAX_ENTRIES = 128
+# A briefing whose event volume changed by more than this factor is treated as
+# a new situation, however similar the rest of the text reads
+SEMANTIC_CACHE_MAX_VOLUME_RATIO = 2.0
+SEMANTIC_CACHE_KEY = "ai_semantic_cache"  # JSON list, least recently used first
 
 # --- Configure Gemini AI ---
 try:
     genai.configure(api_key=GEMINI_API_KEY)
     model = genai.GenerativeModel('gemini-2.5-pro')
+    # Ask Gemini for schema-conforming raw JSON so the reply needs no cleanup
+    generation_config = genai.GenerationConfig(response_mime_type="application/json", response_schema=AI_RESPONSE_SCHEMA)
 except Exception as e:
     print(f"FATAL ERROR: Could not configure Gemini AI. Check your API key. Error: {e}")
     model = None
 
 # --- Elasticsearch Connection ---
 try:
-    es = Elasticsearch(ES_HOST, request_timeout=30)
+    es = Elasticsearch(
+        ES_HOST,
+        request_timeout=30,
+        connections_per_node=ES_CONNECTIONS_PER_NODE,
+        retry_on_timeout=True,
+        max_retries=2,
+        # gzip request and response bodies; the client decompresses transparently
+        http_compress=True,
+        serializer=OrjsonSerializer(),
+    )
     if not es.ping():
         raise ConnectionError("Could not connect to Elasticsearch.")
 except ConnectionError as e:
     print(f"FATAL ERROR: Could not connect to Elasticsearch at {ES_HOST}.")
     es = None
 
+# --- Elasticsearch Queries ---
+# top_hits may not return more than index.max_inner_result_window (default 100) hits
+MAP_POINTS = 100
+
+# Time ranges go in bool filter context: nothing here needs relevance scoring,
+# and filters can be served from the Elasticsearch filter cache. Both bounds are
+# rounded (to the minute for the AI briefing, to the hour for the dashboard) so
+# repeated refreshes within that unit send identical queries that the shard
+# request cache can answer. Date math rounding only accepts a single unit.
+# The bodies are built once at import; only relative date math varies between
+# runs and Elasticsearch resolves it, so they are passed to the client as-is.
+_AI_QUERY_BODY = {
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-15m/m", "lte": "now/m"}}}]}},
+    "size": 0,
+    "track_total_hits": False,
+    "aggs": {
+        "total_events": {"value_count": {"field": "@timestamp"}},
+        "unique_ips": {"cardinality": {"field": "source_ip.keyword"}},
+        "top_countries": {"terms": {"field": "geoip.country_name.keyword", "size": 5}},
+        "top_honeypots": {"terms": {"field": "honeypot.keyword", "size": 5}},
+        "top_ports": {"terms": {"field": "dest_port", "size": 5}},
+        "top_passwords": {"terms": {"field": "password.keyword", "size": 5}}
+    }
+}
+
+_DASHBOARD_QUERY_BODY = {
+    "size": 0, "track_total_hits": True, "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-24h/h", "lte": "now/h"}}}]}},
+    "aggs": {
+        "unique_attackers": {"cardinality": {"field": "source_ip.keyword"}},
+        "attacks_over_time": {"date_histogram": {"field": "@timestamp", "fixed_interval": "1h", "min_doc_count": 0, "extended_bounds": {"min": "now-24h/h", "max": "now/h"}}},
+        "attacks_by_country": {"terms": {"field": "geoip.country_name.keyword", "size": 10}},
+        "attacks_by_honeypot": {"terms": {"field": "honeypot.keyword", "size": 10}},
+        "top_attacked_ports": {"terms": {"field": "dest_port", "size": 10}},
+        "top_attacker_ips": {"terms": {"field": "source_ip.keyword", "size": 10}},
+        "top_usernames": {"terms": {"field": "user.keyword", "size": 15}},
+        "top_passwords": {"terms": {"field": "password.keyword", "size": 15}},
+        # Latest geolocated hits for the attack map, projected to the fields it plots
+        "recent_for_map": {
+            "filter": {"exists": {"field": "geoip.location"}},
+            "aggs": {"latest": {"top_hits": {
+                "size": MAP_POINTS,
+                "_source": {"includes": ["geoip.location.lat", "geoip.location.lon", "source_ip", "geoip.country_name", "honeypot"]},
+                "sort": [{"@timestamp": "desc"}]
+            }}}
+        }
+    }
+}
+
+# Keep only what the refreshers read; per-hit metadata (_index, _id, _score, sort)
+# is dropped. "status" is always present, so no entry is filtered out entirely.
+_MSEARCH_FILTER_PATH = [
+    "responses.status",
+    "responses.error",
+    "responses.hits.total",
+    "responses.aggregations.*.value",
+    "responses.aggregations.*.buckets",
+    "responses.aggregations.recent_for_map.latest.hits.hits._source",
+]
+
+def _msearch(bodies, request_timeout):
+    """Runs the query bodies against INDEX_PATTERN in a single msearch round-trip."""
+    searches = []
+    for body in bodies:
+        searches += [{"index": INDEX_PATTERN, "request_cache": True}, body]
+    return es.options(request_timeout=request_timeout).msearch(searches=searches, filter_path=_MSEARCH_FILTER_PATH)["responses"]
+
+def _raise_for_error(response):
+    # msearch entries succeed or fail on their own
+    if "error" in response:
+        raise RuntimeError(response["error"])
+
+# --- Worker Coordination ---
+def _claim_run(job_name, interval_seconds):
+    """Returns True if this worker won this interval's run of the job.
+
+    Every gunicorn worker runs the scheduler; the first to claim a run does the
+    work and the others skip it. The claim expires shortly before the next
+    interval so that run can be claimed again.
+    """
+    try:
+        return bool(redis_client.set(f"{job_name}_lock", os.getpid(), nx=True, ex=max(1, interval_seconds - 5)))
+    except redis.RedisError as e:
+        print(f"REDIS ERROR: Could not claim {job_name} run. Error: {e}")
+        return False
+
+# --- AI Exact-Match Cache Helpers ---
+def _open_exact_cache():
+    os.makedirs(EXACT_CACHE_DIR, exist_ok=True)
+    return shelve.open(EXACT_CACHE_PATH)
+
+def _exact_cache_lookup(key):
+    """Returns the cached analysis for an identical briefing, or None."""
+    try:
+        with _open_exact_cache() as db:
+            entry = db.get(key)
+    except Exception as e:
+        print(f"AI TASK: Could not read exact-match cache. Error: {e}")
+        return None
+    if entry and time.time() - entry[1] < EXACT_CACHE_TTL:
+        return entry[0]
+    return None
+
+def _exact_cache_store(key, ai_result):
+    try:
+        with _open_exact_cache() as db:
+            now = time.time()
+            for stale_key in [k for k, (_, ts) in db.items() if now - ts >= EXACT_CACHE_TTL]:
+                del db[stale_key]
+            db[key] = (ai_result, now)
+    except Exception as e:
+        print(f"AI TASK: Could not write exact-match cache. Error: {e}")
+
+# --- AI Semantic Cache Helpers ---
+def _embed_briefing(briefing):
+    """Returns the unit-length embedding of the briefing, or None if embedding failed."""
+    try:
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=briefing)
+        embedding = np.asarray(result["embedding"], dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+    except Exception as e:
+        print(f"AI TASK: Could not embed briefing, skipping semantic cache. Error: {e}")
+        return None
+
+def _load_semantic_cache():
+    try:
+        raw = redis_client.get(SEMANTIC_CACHE_KEY)
+    except redis.RedisError as e:
+        print(f"AI TASK: Could not read semantic cache. Error: {e}")
+        return []
+    entries = orjson.loads(raw) if raw else []
+    for entry in entries:
+        entry["embedding"] = np.asarray(entry["embedding"], dtype=np.float32)
+    return entries
+
+def _save_semantic_cache(entries):
+    try:
+        redis_client.set(SEMANTIC_CACHE_KEY, orjson.dumps(entries, option=orjson.OPT_SERIALIZE_NUMPY), ex=SEMANTIC_CACHE_TTL)
+    except redis.RedisError as e:
+        print(f"AI TASK: Could not write semantic cache. Error: {e}")
+
+def _semantic_cache_lookup(embedding, total_events):
+    """Returns a cached analysis for a near-identical briefing, or None."""
+    now = time.time()
+    entries = [entry for entry in _load_semantic_cache() if now - entry["ts"] < SEMANTIC_CACHE_TTL]
+    if not entries:
+        return None
+    # Embeddings are unit length, so the dot product is the cosine similarity
+    similarities = np.stack([entry["embedding"] for entry in entries]) @ embedding
+    best = int(np.argmax(similarities))
+    entry = entries[best]
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    low, high = sorted((entry["total_events"], total_events))
+    if high > low * SEMANTIC_CACHE_MAX_VOLUME_RATIO:
+        return None
+    # Move to the end to mark it most recently used
+    entries.append(entries.pop(best))
+    _save_semantic_cache(entries)
+    return entry["result"]
+
+def _semantic_cache_store(embedding, ai_result, total_events):
+    now = time.time()
+    entries = [entry for entry in _load_semantic_cache() if now - entry["ts"] < SEMANTIC_CACHE_TTL]
+    entries.append({"embedding": embedding, "result": ai_result, "ts": now, "total_events": total_events})
+    _save_semantic_cache(entries[-SEMANTIC_CACHE_MAX_ENTRIES:])
+
 # --- AI Analysis Background Task ---
-def fetch_and_analyze_data():
-    global ai_analysis_cache
+def fetch_and_analyze_data(response=None):
+    """Runs the AI analysis, querying Elasticsearch unless a search response is passed in."""
     if not es or not model:
         print("AI ANALYSIS SKIPPED: Elasticsearch or Gemini model not available.")
         return
 
+    if not _ai_lock.acquire(blocking=False):
+        print("AI TASK SKIPPED: Previous analysis is still running.")
+        return
+    try:
+        _run_analysis(response)
+    finally:
+        _ai_lock.release()
+
+def _run_analysis(response):
     print(f"AI TASK: Running scheduled analysis at {datetime.now()}")
     try:
         # 1. Aggregate recent data (last 15 minutes)
-        query_body = {
-            "query": {"range": {"@timestamp": {"gte": "now-15m/m"}}},
-            "size": 0,
-            "aggs": {
-                "unique_ips": {"cardinality": {"field": "source_ip.keyword"}},
-                "top_countries": {"terms": {"field": "geoip.country_name.keyword", "size": 5}},
-                "top_honeypots": {"terms": {"field": "honeypot.keyword", "size": 5}},
-                "top_ports": {"terms": {"field": "dest_port", "size": 5}},
-                "top_passwords": {"terms": {"field": "password.keyword", "size": 5}}
-            }
-        }
-        response = es.search(index=INDEX_PATTERN, **query_body)
+        if response is None:
+            response = es.options(request_timeout=ES_AI_QUERY_TIMEOUT).search(index=INDEX_PATTERN, request_cache=True, **_AI_QUERY_BODY)
+        _raise_for_error(response)
         aggs = response.get('aggregations', {})
-        total_events = response['hits']['total']['value']
+        total_events = aggs.get('total_events', {}).get('value', 0)
 
         if total_events == 0:
             print("AI TASK: No new events to analyze.")
-            # Keep the old analysis if there's no new data
+            # Keep the old analysis if there's no new data, pushing back its expiry
+            redis_client.expire(AI_ANALYSIS_KEY, AI_ANALYSIS_TTL)
             return
 
         # 2. Create a concise text summary (the "briefing")
-        briefing = f"Honeypot Security Briefing (last 15 mins):\n"
-        briefing += f"- Total Events: {total_events}\n"
-        briefing += f"- Unique Attacker IPs: {aggs.get('unique_ips', {}).get('value', 0)}\n"
-        briefing += f"- Top Attacking Countries: {[b['key'] for b in aggs.get('top_countries', {}).get('buckets', [])]}\n"
-        briefing += f"- Top Targeted Honeypots: {[b['key'] for b in aggs.get('top_honeypots', {}).get('buckets', [])]}\n"
-        briefing += f"- Top Targeted Ports: {[b['key'] for b in aggs.get('top_ports', {}).get('buckets', [])]}\n"
-        briefing += f"- Top Passwords Attempted: {[b['key'] for b in aggs.get('top_passwords', {}).get('buckets', [])]}\n"
-
-        # 3. Create the intelligent prompt
-        prompt = f"""
-        You are a senior cybersecurity analyst. Based on the following honeypot activity summary, provide a concise analysis in JSON format. The JSON object must have three keys: "summary", "threat_type", and "recommendations".
-
-        - "summary": A brief, one-sentence summary of the activity in plain English.
-        - "threat_type": A short, descriptive label for the dominant threat pattern (e.g., "Automated Scanning", "SSH Brute-Force", "Web Server Probing", "Coordinated Attack").
-        - "recommendations": A JSON array of 2 short, actionable mitigation steps a security admin should take.
-
-        Here is the data:
-        {briefing}
-
-        Provide only the raw JSON object as your response.
-        """
-        
-        print("AI TASK: Sending data to Gemini for analysis...")
-        # 4. Call the Gemini API
-        response = model.generate_content(prompt)
-        
-        # 5. Parse and cache the response
-        # A simple but effective way to clean the response
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-        import json
-        ai_result = json.loads(cleaned_response)
+        briefing = "\n".join([
+            "Honeypot Security Briefing (last 15 mins):",
+            f"- Total Events: {total_events}",
+            f"- Unique Attacker IPs: {aggs.get('unique_ips', {}).get('value', 0)}",
+            f"- Top Attacking Countries: {[b['key'] for b in aggs.get('top_countries', {}).get('buckets', [])]}",
+            f"- Top Targeted Honeypots: {[b['key'] for b in aggs.get('top_honeypots', {}).get('buckets', [])]}",
+            f"- Top Targeted Ports: {[b['key'] for b in aggs.get('top_ports', {}).get('buckets', [])]}",
+            f"- Top Passwords Attempted: {[b['key'] for b in aggs.get('top_passwords', {}).get('buckets', [])]}",
+        ])
+
+        # 3. Reuse the analysis of an identical, then a near-identical, recent briefing if there is one
+        briefing_key = hashlib.sha256(briefing.encode()).hexdigest()
+        embedding = None
+        cached_result = _exact_cache_lookup(briefing_key)
+        if cached_result:
+            print("AI TASK: Identical briefing found in exact-match cache, skipping Gemini.")
+        else:
+            embedding = _embed_briefing(briefing)
+            cached_result = _semantic_cache_lookup(embedding, total_events) if embedding is not None else None
+            if cached_result:
+                print("AI TASK: Similar briefing found in semantic cache, skipping Gemini.")
+        if cached_result:
+            ai_result = dict(cached_result)
+        else:
+            # 4. Create the intelligent prompt and call the Gemini API
+            prompt = AI_PROMPT_TEMPLATE.format(briefing=briefing)
+            print("AI TASK: Sending data to Gemini for analysis...")
+            response = model.generate_content(prompt, generation_config=generation_config)
+            ai_result = orjson.loads(response.text)
+            _exact_cache_store(briefing_key, dict(ai_result))
+            if embedding is not None:
+                _semantic_cache_store(embedding, dict(ai_result), total_events)
+
+        # 5. Cache the analysis for the API
         ai_result["last_updated"] = datetime.now().isoformat()
-        ai_analysis_cache = ai_result
+        redis_client.set(AI_ANALYSIS_KEY, orjson.dumps(ai_result), ex=AI_ANALYSIS_TTL)
         print(f"AI TASK: Analysis complete and cache updated.")
 
     except Exception as e:
         print(f"AI TASK ERROR: {e}")
 
-# --- API Endpoints ---
-@app.route('/')
-def health_check():
-    return jsonify({"status": "ok", "message": "T-Pot Dashboard API is running."})
+# --- Dashboard Background Task ---
+_DASHBOARD_BUCKET_AGGS = (
+    "attacks_over_time", "attacks_by_country", "attacks_by_honeypot", "top_attacked_ports",
+    "top_attacker_ips", "top_usernames", "top_passwords",
+)
 
-@app.route('/api/dashboard')
-def get_dashboard_data():
-    # This endpoint remains the same as before, providing chart/map data
+def _format_buckets(buckets):
+    return [{"name": b['key'], "value": b['doc_count']} for b in buckets]
+
+def _map_points(hits):
+    # Hot loop over every map hit: bind each nested dict once instead of re-walking it per field
+    points = []
+    append = points.append
+    for h in hits:
+        src = h.get('_source') or {}
+        geo = src.get('geoip') or {}
+        loc = geo.get('location')
+        if not loc:
+            continue
+        append({"lat": loc['lat'], "lon": loc['lon'], "ip": src.get('source_ip', 'N/A'), "country": geo.get('country_name', 'N/A'), "honeypot": src.get('honeypot', 'N/A')})
+    return points
+
+def _refresh_dashboard_cache(response=None):
+    """Rebuilds the dashboard cache, querying Elasticsearch unless a search response is passed in."""
     if not es:
-        return jsonify({"error": "Elasticsearch connection not available"}), 500
+        print("DASHBOARD REFRESH SKIPPED: Elasticsearch not available.")
+        return
+    # Scheduled runs are claimed by one worker; a response handed in by the combined task is always used
+    if response is None and not _claim_run("dashboard", DASHBOARD_REFRESH_SECONDS):
+        return
+    # Skip if a previous refresh is still running rather than queueing up behind it
+    if not _dashboard_cache_lock.acquire(blocking=False):
+        return
     try:
-        # The original dashboard query logic...
-        query_body = {
-            "size": 200, "query": {"range": {"@timestamp": {"gte": "now-24h/h"}}},
-            "aggs": {
-                "unique_attackers": {"cardinality": {"field": "source_ip.keyword"}},
-                "attacks_over_time": {"date_histogram": {"field": "@timestamp", "fixed_interval": "1h", "min_doc_count": 0, "extended_bounds": {"min": "now-24h/h", "max": "now/h"}}},
-                "attacks_by_country": {"terms": {"field": "geoip.country_name.keyword", "size": 10}},
-                "attacks_by_honeypot": {"terms": {"field": "honeypot.keyword", "size": 10}},
-                "top_attacked_ports": {"terms": {"field": "dest_port", "size": 10}},
-                "top_attacker_ips": {"terms": {"field": "source_ip.keyword", "size": 10}},
-                "top_usernames": {"terms": {"field": "user.keyword", "size": 15}},
-                "top_passwords": {"terms": {"field": "password.keyword", "size": 15}}
-            },
-            "sort": [{"@timestamp": "desc"}]
-        }
-        response = es.search(index=INDEX_PATTERN, **query_body)
+        if response is None:
+            response = _msearch([_DASHBOARD_QUERY_BODY], ES_DASHBOARD_TIMEOUT)[0]
+        _raise_for_error(response)
         # The original data processing logic...
-        aggregations = response.get('aggregations', {})
-        def format_buckets(agg_data):
-            if not agg_data or 'buckets' not in agg_data: return []
-            return [{"name": bucket['key'], "value": bucket['doc_count']} for bucket in agg_data['buckets']]
-        country_buckets = aggregations.get('attacks_by_country', {}).get('buckets', [])
-        honeypot_buckets = aggregations.get('attacks_by_honeypot', {}).get('buckets', [])
+        aggs = response.get('aggregations') or {}
+        # Pull each terms/histogram bucket list out of the response once
+        buckets = {name: aggs.get(name, {}).get('buckets') or [] for name in _DASHBOARD_BUCKET_AGGS}
+        country_buckets = buckets['attacks_by_country']
+        honeypot_buckets = buckets['attacks_by_honeypot']
         dashboard_data = {
             "kpi_total_attacks": response['hits']['total']['value'],
-            "kpi_unique_attackers": aggregations.get('unique_attackers', {}).get('value', 0),
+            "kpi_unique_attackers": aggs.get('unique_attackers', {}).get('value', 0),
             "kpi_top_country": country_buckets[0]['key'] if country_buckets else 'N/A',
             "kpi_top_honeypot": honeypot_buckets[0]['key'] if honeypot_buckets else 'N/A',
-            "chart_attacks_over_time": format_buckets(aggregations.get('attacks_over_time')),
-            "chart_attacks_by_country": format_buckets(aggregations.get('attacks_by_country')),
-            "chart_attacks_by_honeypot": format_buckets(aggregations.get('attacks_by_honeypot')),
-            "chart_top_ports": format_buckets(aggregations.get('top_attacked_ports')),
-            "table_top_attackers": format_buckets(aggregations.get('top_attacker_ips')),
-            "list_top_usernames": [b['key'] for b in aggregations.get('top_usernames', {}).get('buckets', [])],
-            "list_top_passwords": [b['key'] for b in aggregations.get('top_passwords', {}).get('buckets', [])],
-            "map_recent_attacks": [
-                {"lat": h['_source']['geoip']['location']['lat'], "lon": h['_source']['geoip']['location']['lon'], "ip": h['_source'].get('source_ip', 'N/A'), "country": h['_source']['geoip'].get('country_name', 'N/A'), "honeypot": h['_source'].get('honeypot', 'N/A')}
-                for h in response['hits']['hits'] if h.get('_source', {}).get('geoip', {}).get('location')
-            ]
+            "chart_attacks_over_time": _format_buckets(buckets['attacks_over_time']),
+            "chart_attacks_by_country": _format_buckets(country_buckets),
+            "chart_attacks_by_honeypot": _format_buckets(honeypot_buckets),
+            "chart_top_ports": _format_buckets(buckets['top_attacked_ports']),
+            "table_top_attackers": _format_buckets(buckets['top_attacker_ips']),
+            "list_top_usernames": [b['key'] for b in buckets['top_usernames']],
+            "list_top_passwords": [b['key'] for b in buckets['top_passwords']],
+            "map_recent_attacks": _map_points(aggs.get('recent_for_map', {}).get('latest', {}).get('hits', {}).get('hits', []))
         }
-        return jsonify(dashboard_data)
+        redis_client.set(DASHBOARD_KEY, orjson.dumps(dashboard_data))
+    except Exception as e:
+        print(f"DASHBOARD REFRESH ERROR: {e}")
+    finally:
+        _dashboard_cache_lock.release()
+
+# --- Combined Refresh Task ---
+def refresh_dashboard_and_analysis():
+    """Refreshes the dashboard cache and runs the AI analysis from a single msearch round-trip."""
+    if not es:
+        print("COMBINED REFRESH SKIPPED: Elasticsearch not available.")
+        return
+    if not _ai_lock.acquire(blocking=False):
+        print("COMBINED REFRESH SKIPPED: Previous analysis is still running.")
+        return
+    try:
+        if not _claim_run("ai", AI_REFRESH_SECONDS):
+            return
+        bodies = [_DASHBOARD_QUERY_BODY]
+        if model:
+            bodies.append(_AI_QUERY_BODY)
+        try:
+            responses = _msearch(bodies, ES_AI_QUERY_TIMEOUT if model else ES_DASHBOARD_TIMEOUT)
+        except Exception as e:
+            print(f"COMBINED REFRESH ERROR: {e}")
+            return
+
+        _refresh_dashboard_cache(responses[0])
+        if model:
+            fetch_and_analyze_data(responses[1])
+    finally:
+        _ai_lock.release()
+
+# --- Elasticsearch Keepalive Task ---
+def _ping_elasticsearch():
+    # Periodic traffic keeps pooled connections warm so idle sockets are not
+    # silently dropped between the less frequent AI queries.
+    if not es:
+        return
+    try:
+        if not es.options(request_timeout=ES_PING_TIMEOUT).ping():
+            print("ES KEEPALIVE: Elasticsearch did not respond to ping.")
     except Exception as e:
+        print(f"ES KEEPALIVE ERROR: {e}")
+
+# --- API Endpoints ---
+@app.route('/')
+def health_check():
+    return jsonify({"status": "ok", "message": "T-Pot Dashboard API is running."})
+
+@app.route('/api/dashboard')
+def get_dashboard_data():
+    """Instantly returns the latest cached dashboard data."""
+    if not es:
+        return jsonify({"error": "Elasticsearch connection not available"}), 500
+    try:
+        body = redis_client.get(DASHBOARD_KEY)
+    except redis.RedisError as e:
         print(f"ERROR in get_dashboard_data: {e}")
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": "Cache connection not available"}), 500
+    if body is None:
+        return jsonify({"error": "Dashboard data is initializing. Please check back in a few seconds..."}), 503
+    return Response(body, mimetype="application/json")
 
 @app.route('/api/ai-analysis', methods=['GET'])
 def get_ai_analysis():
     """Instantly returns the latest cached AI analysis."""
-    return jsonify(ai_analysis_cache)
+    try:
+        body = redis_client.get(AI_ANALYSIS_KEY)
+    except redis.RedisError as e:
+        print(f"ERROR in get_ai_analysis: {e}")
+        return jsonify({"error": "Cache connection not available"}), 500
+    if body is None:
+        body = orjson.dumps(AI_ANALYSIS_PLACEHOLDER)
+    return Response(body, mimetype="application/json")
 
-# --- Main Execution ---
-if __name__ == '__main__':
-    # Run the first analysis shortly after startup
-    # Using a thread to avoid blocking the main app startup
-    threading.Timer(10, fetch_and_analyze_data).start()
+# --- Background Jobs ---
+scheduler = None
+
+def start_background_jobs():
+    """Starts the scheduled refresh jobs once per process (called by the dev server and the gunicorn hook).
 
-    # Schedule the AI analysis to run every 10 minutes
+    Each worker runs its own scheduler; _claim_run makes sure only one of them
+    does the work for any given interval.
+    """
+    global scheduler
+    if scheduler:
+        return
+    # Schedule the AI analysis (sharing one msearch with a dashboard refresh) to run
+    # every 10 minutes, and the dashboard data on its own every 30 seconds. The first
+    # runs come shortly after startup, from the scheduler's own thread pool.
+    now = datetime.now()
     scheduler = BackgroundScheduler(daemon=True)
-    scheduler.add_job(fetch_and_analyze_data, 'interval', minutes=10)
+    scheduler.add_job(refresh_dashboard_and_analysis, 'interval', seconds=AI_REFRESH_SECONDS,
+                      next_run_time=now + timedelta(seconds=10), id='ai-analysis',
+                      max_instances=1, coalesce=True, misfire_grace_time=60)
+    scheduler.add_job(_refresh_dashboard_cache, 'interval', seconds=DASHBOARD_REFRESH_SECONDS,
+                      next_run_time=now + timedelta(seconds=2), id='dashboard-refresh')
+    scheduler.add_job(_ping_elasticsearch, 'interval', minutes=2, id='es-keepalive')
     scheduler.start()
-    
+
+# --- Main Execution ---
+# Development server only; in production run: gunicorn -c gunicorn.conf.py api:app
+if __name__ == '__main__':
+    start_background_jobs()
     print("Starting T-Pot Dashboard API Server with AI Analyst...")
     app.run(host='0.0.0.0', port=5001)
-
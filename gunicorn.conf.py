@@ -0,0 +1,18 @@
+#========================#
+# GUNICORN SERVER CONFIG #
+#========================#
+# Usage: gunicorn -c gunicorn.conf.py api:app
+
+bind = "0.0.0.0:5001"
+
+# The dashboard and AI caches live in Redis, so every worker serves the same
+# data; the scheduled jobs are claimed by one worker per interval.
+workers = 4
+worker_class = "gthread"
+threads = 8
+
+def post_worker_init(worker):
+    # Start the scheduler inside the worker that serves requests, not in the master
+    from api import start_background_jobs
+    start_background_jobs()
+    print("Starting T-Pot Dashboard API Server with AI Analyst...")